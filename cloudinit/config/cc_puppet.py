@@ -26,12 +26,14 @@ Puppet
 This module handles puppet installation and configuration. If the ``puppet``
 key does not exist in global configuration, no action will be taken. If a
 config entry for ``puppet`` is present, then by default the latest version of
-puppet will be installed. If ``install`` is set to ``false``, puppet will not
-be installed. However, this may result in an error if puppet is not already
-present on the system. The version of puppet to be installed can be specified
-under ``version``, and defaults to ``none``, which selects the latest version
-in the repos. If the ``puppet`` config key exists in the config archive, this
-module will attempt to start puppet even if no installation was performed.
+puppet will be installed, unless the package is already installed. If
+``install`` is set to ``false``, puppet will not be installed. However, this
+may result in an error if puppet is not already present on the system. The
+version of puppet to be installed can be specified under ``version``, and
+defaults to ``none``, which selects the latest version in the repos. The
+package manager is not run if the requested version is already installed. If
+the ``puppet`` config key exists in the config archive, this module will
+attempt to start puppet even if no installation was performed.
 
 The module also provides keys for configuring the new puppet 4 paths and
 installing the puppet package from the puppetlabs repositories:
@@ -73,18 +75,44 @@ yaml notation).
                 -------END CERTIFICATE-------
 """
 
-from six import StringIO
-
+import collections
+import grp
 import os
-import socket
+import pwd
+import re
 
-from cloudinit import helpers
 from cloudinit import util
 
 DEFAULT_PACKAGE_NAME = 'puppet'
 DEFAULT_SSL_DIR = '/var/lib/puppet/ssl'
 DEFAULT_CONF_DIR = '/etc/puppet'
 
+_DEFAULT_CONF_PATH = os.path.join(DEFAULT_CONF_DIR, "puppet.conf")
+_DEFAULT_SSL_CERT_DIR = os.path.join(DEFAULT_SSL_DIR, "certs")
+_DEFAULT_SSL_CERT_PATH = os.path.join(_DEFAULT_SSL_CERT_DIR, "ca.pem")
+
+_SECTION_RE = re.compile(r'^\[([^\]]+)\]')
+_KV_RE = re.compile(r'^\s*([^=:\s][^=:]*)\s*[=:]\s*(.*)$')
+_LEADING_WS_RE = re.compile(r'(?m)^[ \t]+')
+_CERTNAME_TOKEN_RE = re.compile(r'%[fi]')
+
+# (path probed, command that enables puppet, whether that command also
+# starts puppet), checked in order
+_AUTOSTART_CANDIDATES = (
+    ('/etc/default/puppet',
+     ['sed', '-i', '-e', 's/^START=.*/START=yes/', '/etc/default/puppet'],
+     False),
+    ('/bin/systemctl',
+     ['/bin/systemctl', 'enable', '--now', 'puppet.service'], True),
+    ('/sbin/chkconfig', ['/sbin/chkconfig', 'puppet', 'on'], False),
+)
+
+# Where puppet 3.x and puppet 4.x agents write their pid
+_AGENT_PIDFILES = (
+    '/var/run/puppet/agent.pid',
+    '/var/run/puppetlabs/agent.pid',
+)
+
 
 class PuppetConstants(object):
 
@@ -93,27 +121,166 @@ class PuppetConstants(object):
                  puppet_ssl_dir,
                  log):
         self.conf_dir = puppet_conf_dir
-        self.conf_path = os.path.join(puppet_conf_dir, "puppet.conf")
+        if puppet_conf_dir == DEFAULT_CONF_DIR:
+            self.conf_path = _DEFAULT_CONF_PATH
+        else:
+            self.conf_path = os.path.join(puppet_conf_dir, "puppet.conf")
         self.ssl_dir = puppet_ssl_dir
-        self.ssl_cert_dir = os.path.join(puppet_ssl_dir, "certs")
-        self.ssl_cert_path = os.path.join(self.ssl_cert_dir,
-                                          "ca.pem")
+        if puppet_ssl_dir == DEFAULT_SSL_DIR:
+            self.ssl_cert_dir = _DEFAULT_SSL_CERT_DIR
+            self.ssl_cert_path = _DEFAULT_SSL_CERT_PATH
+        else:
+            self.ssl_cert_dir = os.path.join(puppet_ssl_dir, "certs")
+            self.ssl_cert_path = os.path.join(self.ssl_cert_dir,
+                                              "ca.pem")
+
+
+def _parse_puppet_conf(contents):
+    # puppet.conf only uses the '[section]' and 'key = value' subset of
+    # the ini format, so a line based parser is enough (and is much
+    # cheaper than building a ConfigParser); comments are dropped and
+    # option names lower-cased just like ConfigParser would. Anything
+    # else is refused (again like ConfigParser) so that we never rewrite
+    # the file without it.
+    sections = collections.OrderedDict()
+    options = None
+    for (lineno, line) in enumerate(contents.splitlines(), 1):
+        line = line.rstrip()
+        if not line or line[0] in '#;':
+            continue
+        match = _SECTION_RE.match(line)
+        if match:
+            options = sections.setdefault(match.group(1),
+                                          collections.OrderedDict())
+            continue
+        if options is None:
+            raise ValueError("Line %s of puppet.conf is not in a section:"
+                             " %r" % (lineno, line))
+        match = _KV_RE.match(line)
+        if not match:
+            raise ValueError("Unable to parse line %s of puppet.conf: %r"
+                             % (lineno, line))
+        options[match.group(1).strip().lower()] = match.group(2)
+    return sections
+
+
+def _write_puppet_conf(fh, sections):
+    # Streams the sections out to fh (opened in binary mode) in the
+    # same layout RawConfigParser.write() uses
+    for (section, options) in sections.items():
+        fh.write(util.encode_text("[%s]\n" % (section)))
+        for (o, v) in options.items():
+            fh.write(util.encode_text("%s = %s\n" % (o, v)))
+        fh.write(b"\n")
+
+
+def _expand_certname(certname, cloud, lookups):
+    # Expands %f and %i in a single pass over certname, looking each of
+    # them up at most once (lookups is kept around by the caller)
+    def replace(match):
+        token = match.group(0)
+        if token not in lookups:
+            if token == '%f':
+                # Expand %f as the fqdn
+                # TODO(harlowja) should this use the cloud fqdn??
+                # Late import, only needed for this
+                import socket
+                lookups[token] = socket.getfqdn()
+            else:
+                # Expand %i as the instance id
+                lookups[token] = cloud.get_instance_id()
+        return lookups[token]
+
+    # certname needs to be downcased
+    return _CERTNAME_TOKEN_RE.sub(replace, certname).lower()
+
+
+def _get_puppet_ids(user='puppet', group='root'):
+    # Resolve the owner of the puppet ssl tree once, instead of once
+    # per path as util.chownbyname() would
+    try:
+        return (pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid)
+    except KeyError as e:
+        raise OSError("Unknown user or group: %s" % (e))
+
+
+def _detect_autostart():
+    # Returns (command, starts) for the first init system found, or
+    # None if none of them are present
+    for (path, cmd, starts) in _AUTOSTART_CANDIDATES:
+        if os.path.exists(path):
+            return (cmd, starts)
+    return None
 
 
 def _autostart_puppet(log):
-    # Set puppet to automatically start
-    if os.path.exists('/etc/default/puppet'):
-        util.subp(['sed', '-i',
-                   '-e', 's/^START=.*/START=yes/',
-                   '/etc/default/puppet'], capture=False)
-    elif os.path.exists('/bin/systemctl'):
-        util.subp(['/bin/systemctl', 'enable', 'puppet.service'],
-                  capture=False)
-    elif os.path.exists('/sbin/chkconfig'):
-        util.subp(['/sbin/chkconfig', 'puppet', 'on'], capture=False)
-    else:
+    # Set puppet to automatically start, returns True if that
+    # also started it
+    found = _detect_autostart()
+    if not found:
         log.warn(("Sorry we do not know how to enable"
                   " puppet services on this system"))
+        return False
+    (cmd, starts) = found
+    if not starts:
+        util.subp(cmd, capture=False)
+        return False
+    try:
+        # Captured so that an error can be told apart from an old
+        # systemctl rejecting the option
+        util.subp(cmd)
+    except util.ProcessExecutionError as e:
+        # systemd before 220 does not know about 'enable --now', any
+        # other failure (ie puppet failing to start) is a real one
+        if '--now' not in e.stderr:
+            raise
+        log.debug("systemctl does not support 'enable --now',"
+                  " enabling puppet only")
+        util.subp([c for c in cmd if c != '--now'], capture=False)
+        return False
+    return True
+
+
+def _installed_version(distro, pkg):
+    # Returns the installed version of pkg, or None if it is not
+    # installed (or we do not know how to ask this distro)
+    if distro.osfamily == 'debian':
+        cmd = ['dpkg-query', '-W', '-f=${Status} ${Version}', pkg]
+    elif distro.osfamily in ('redhat', 'suse'):
+        cmd = ['rpm', '-q', '--qf', 'installed %{VERSION}-%{RELEASE}', pkg]
+    else:
+        return None
+    try:
+        (out, _err) = util.subp(cmd)
+    except util.ProcessExecutionError:
+        return None
+    toks = out.split()
+    if len(toks) < 2 or toks[-2] != 'installed':
+        # ie dpkg's 'deinstall ok config-files'
+        return None
+    return toks[-1]
+
+
+def _version_matches(installed, wanted):
+    # Any version will do if none was asked for, and asking for '3.8.5'
+    # is satisfied by an installed '3.8.5-1'
+    if not wanted:
+        return True
+    return wanted in (installed, installed.split('-', 1)[0])
+
+
+def _puppet_running():
+    # Check for a live agent through its pidfile, so that we do not
+    # need to fork anything to find out; the pid has to still belong
+    # to puppet, it may have been reused since the pidfile was written
+    for pidfile in _AGENT_PIDFILES:
+        pid = util.safe_int(util.load_file(pidfile, quiet=True).strip())
+        if not pid:
+            continue
+        cmdline = util.load_file("/proc/%s/cmdline" % (pid), quiet=True)
+        if 'puppet' in cmdline:
+            return True
+    return False
 
 
 def handle(name, cfg, cloud, log, _args):
@@ -124,18 +291,19 @@ def handle(name, cfg, cloud, log, _args):
         return
 
     puppet_cfg = cfg['puppet']
+    # The steps below have to run one after the other: installing the
+    # package is what provides the puppet user, puppet.conf and the
+    # init system bits (ie /etc/default/puppet) that the later steps
+    # chown, parse and probe for.
     # Start by installing the puppet package if necessary...
-    install = util.get_cfg_option_bool(puppet_cfg, 'install', True)
-    version = util.get_cfg_option_str(puppet_cfg, 'version', None)
-    package_name = util.get_cfg_option_str(puppet_cfg,
-                                           'package_name',
-                                           DEFAULT_PACKAGE_NAME)
-    conf_dir = util.get_cfg_option_str(puppet_cfg,
-                                       'conf_dir',
-                                       DEFAULT_CONF_DIR)
-    ssl_dir = util.get_cfg_option_str(puppet_cfg,
-                                      'ssl_dir',
-                                      DEFAULT_SSL_DIR)
+    install = util.translate_bool(puppet_cfg.get('install', True))
+    version = puppet_cfg.get('version')
+    if version is not None:
+        # yaml may hand us a number (ie 3.8)
+        version = str(version)
+    package_name = puppet_cfg.get('package_name', DEFAULT_PACKAGE_NAME)
+    conf_dir = puppet_cfg.get('conf_dir', DEFAULT_CONF_DIR)
+    ssl_dir = puppet_cfg.get('ssl_dir', DEFAULT_SSL_DIR)
 
     p_constants = PuppetConstants(conf_dir,
                                   ssl_dir,
@@ -144,57 +312,83 @@ def handle(name, cfg, cloud, log, _args):
         log.warn(("Puppet install set false but version supplied,"
                   " doing nothing."))
     elif install:
-        log.debug(("Attempting to install puppet %s,"),
-                  version if version else 'latest')
+        installed = _installed_version(cloud.distro, package_name)
+        if installed and _version_matches(installed, version):
+            log.debug("Puppet %s is already installed, not installing",
+                      installed)
+        else:
+            log.debug(("Attempting to install puppet %s,"),
+                      version if version else 'latest')
 
-        cloud.distro.install_packages((package_name, version))
+            cloud.distro.install_packages((package_name, version))
 
     # ... and then update the puppet configuration
-    if 'conf' in puppet_cfg:
+    conf_items = puppet_cfg.get('conf', {})
+
+    # Cert configuration is a special case
+    # Dump the puppet master ca certificate in the correct place
+    if 'ca_cert' in conf_items:
+        # Puppet ssl sub-directory isn't created yet
+        # Create it with the proper permissions and ownership
+        util.ensure_dir(p_constants.ssl_cert_dir)
+        util.chmod(p_constants.ssl_dir, 0o771)
+        util.write_file(p_constants.ssl_cert_path, conf_items['ca_cert'])
+        # Then hand everything we created over to puppet in one pass
+        (uid, gid) = _get_puppet_ids()
+        for path in (p_constants.ssl_dir, p_constants.ssl_cert_dir,
+                     p_constants.ssl_cert_path):
+            util.chownbyid(path, uid, gid)
+
+    # Only read and rewrite puppet.conf if there is something to put in it
+    if any(k != 'ca_cert' for k in conf_items):
+        # The fqdn and instance id are only looked up (once) if a
+        # certname needs them
+        certname_lookups = {}
         # Add all sections from the conf object to puppet.conf
         contents = util.load_file(p_constants.conf_path)
-        # Create object for reading puppet.conf values
-        puppet_config = helpers.DefaultingConfigParser()
         # Read puppet.conf values from original file in order to be able to
         # mix the rest up. First clean them up
         # (TODO(harlowja) is this really needed??)
-        cleaned_lines = [i.lstrip() for i in contents.splitlines()]
-        cleaned_contents = '\n'.join(cleaned_lines)
-        puppet_config.readfp(StringIO(cleaned_contents),
-                             filename=p_constants.conf_path)
-        for (cfg_name, cfg) in puppet_cfg['conf'].items():
-            # Cert configuration is a special case
-            # Dump the puppet master ca certificate in the correct place
+        cleaned_contents = _LEADING_WS_RE.sub('', contents)
+        puppet_config = _parse_puppet_conf(cleaned_contents)
+        for (cfg_name, cfg) in conf_items.items():
             if cfg_name == 'ca_cert':
-                # Puppet ssl sub-directory isn't created yet
-                # Create it with the proper permissions and ownership
-                util.ensure_dir(p_constants.ssl_dir, 0o771)
-                util.chownbyname(p_constants.ssl_dir, 'puppet', 'root')
-                util.ensure_dir(p_constants.ssl_cert_dir)
-                util.chownbyname(p_constants.ssl_cert_dir, 'puppet', 'root')
-                util.write_file(p_constants.ssl_cert_path, cfg)
-                util.chownbyname(p_constants.ssl_cert_path, 'puppet', 'root')
-            else:
-                # Iterate through the config items, we'll use ConfigParser.set
-                # to overwrite or create new items as needed
-                for (o, v) in cfg.items():
-                    if o == 'certname':
-                        # Expand %f as the fqdn
-                        # TODO(harlowja) should this use the cloud fqdn??
-                        v = v.replace("%f", socket.getfqdn())
-                        # Expand %i as the instance id
-                        v = v.replace("%i", cloud.get_instance_id())
-                        # certname needs to be downcased
-                        v = v.lower()
-                    puppet_config.set(cfg_name, o, v)
-            # We got all our config as wanted we'll rename
-            # the previous puppet.conf and create our new one
-            util.rename(p_constants.conf_path, "%s.old"
-                        % (p_constants.conf_path))
-            util.write_file(p_constants.conf_path, puppet_config.stringify())
-
-    # Set it up so it autostarts
-    _autostart_puppet(log)
-
-    # Start puppetd
-    util.subp(['service', 'puppet', 'start'], capture=False)
+                continue
+            # Iterate through the config items, overwriting or
+            # creating new items as needed
+            for (o, v) in cfg.items():
+                if o == 'certname':
+                    v = _expand_certname(v, cloud, certname_lookups)
+                options = puppet_config.setdefault(cfg_name,
+                                                   collections.OrderedDict())
+                options[o.lower()] = v
+        # We got all our config as wanted we'll keep the previous
+        # puppet.conf as a backup (hardlinked, so puppet.conf itself never
+        # goes missing) and atomically swap our new one in
+        conf_path = p_constants.conf_path
+        if os.path.exists(conf_path):
+            backup_path = "%s.old" % (conf_path)
+            util.del_file(backup_path)
+            os.link(conf_path, backup_path)
+        tmp_path = "%s.tmp" % (conf_path)
+        log.debug("Writing %s", tmp_path)
+        try:
+            with open(tmp_path, 'wb') as fh:
+                _write_puppet_conf(fh, puppet_config)
+            util.chmod(tmp_path, 0o644)
+            with util.SeLinuxGuard(path=conf_path):
+                util.rename(tmp_path, conf_path)
+        except Exception:
+            util.del_file(tmp_path)
+            raise
+
+    # Set it up so it autostarts (on systemd this also starts it)
+    started = _autostart_puppet(log)
+
+    # Start puppetd, unless a previous boot already left it running
+    if started:
+        log.debug("Puppet agent was started while enabling it")
+    elif _puppet_running():
+        log.debug("Puppet agent is already running, not starting it")
+    else:
+        util.subp(['service', 'puppet', 'start'], capture=False)
@@ -0,0 +1,491 @@
+from cloudinit import cloud
+from cloudinit.config import cc_puppet
+from cloudinit import distros
+from cloudinit import helpers
+from cloudinit.sources import DataSourceNone
+from cloudinit import util
+
+from .. import helpers as t_help
+
+import logging
+import os
+import shutil
+from six import BytesIO
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+
+STOCK_CONFIG = """\
+[main]
+logdir=/var/log/puppet
+vardir=/var/lib/puppet
+
+[master]
+ssl_client_header = SSL_CLIENT_S_DN
+"""
+
+
+class TestHandler(t_help.TestCase):
+    def setUp(self):
+        super(TestHandler, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.conf_path = os.path.join(self.tmp, 'puppet.conf')
+        self.start_cmd = ['service', 'puppet', 'start']
+        subp_patch = t_help.mock.patch.object(cc_puppet.util, 'subp')
+        self.mock_subp = subp_patch.start()
+        self.addCleanup(subp_patch.stop)
+        # keep the host's init system out of the picture
+        detect_patch = t_help.mock.patch.object(
+            cc_puppet, '_detect_autostart', return_value=None)
+        detect_patch.start()
+        self.addCleanup(detect_patch.stop)
+        # ... and any puppet agent the host may be running
+        pidfiles_patch = t_help.mock.patch.object(
+            cc_puppet, '_AGENT_PIDFILES',
+            (os.path.join(self.tmp, 'no-such-agent.pid'),))
+        pidfiles_patch.start()
+        self.addCleanup(pidfiles_patch.stop)
+
+    def _get_cloud(self, distro):
+        cls = distros.fetch(distro)
+        paths = helpers.Paths({})
+        d = cls(distro, {}, paths)
+        ds = DataSourceNone.DataSourceNone({}, d, paths)
+        cc = cloud.Cloud(ds, paths, {}, d, None)
+        cc.distro = t_help.mock.MagicMock()
+        return cc
+
+    def _puppet_cfg(self, conf):
+        return {'puppet': {'install': False,
+                           'conf_dir': self.tmp,
+                           'conf': conf}}
+
+    def test_no_config(self):
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {}, cc, LOG, [])
+        self.assertFalse(cc.distro.install_packages.called)
+        self.assertFalse(self.mock_subp.called)
+
+    def test_install_latest(self):
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+        cc.distro.install_packages.assert_called_once_with(('puppet', None))
+        self.assertEqual(self.mock_subp.call_args_list[-1][0][0],
+                         self.start_cmd)
+
+    def test_option_names_merged_case_insensitively(self):
+        util.write_file(self.conf_path, "[agent]\nServer = a\n")
+        cfg = self._puppet_cfg({'agent': {'SERVER': 'b'}})
+        cc_puppet.handle('cc_puppet', cfg, self._get_cloud('ubuntu'),
+                         LOG, [])
+        self.assertEqual(util.load_file(self.conf_path),
+                         "[agent]\nserver = b\n\n")
+
+    def test_multiple_sections_written_once(self):
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        cfg = self._puppet_cfg({'agent': {'server': 'puppet.example.org'},
+                                'main': {'logdir': '/tmp/log'}})
+        cc_puppet.handle('cc_puppet', cfg, self._get_cloud('ubuntu'),
+                         LOG, [])
+        self.assertEqual(util.load_file(self.conf_path + '.old'),
+                         STOCK_CONFIG)
+        found = helpers.DefaultingConfigParser()
+        found.read(self.conf_path)
+        self.assertEqual(found.get('agent', 'server'), 'puppet.example.org')
+        self.assertEqual(found.get('main', 'logdir'), '/tmp/log')
+        self.assertEqual(found.get('main', 'vardir'), '/var/lib/puppet')
+        self.assertEqual(found.get('master', 'ssl_client_header'),
+                         'SSL_CLIENT_S_DN')
+
+    def test_certname_substitution(self):
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        cfg = self._puppet_cfg({'agent': {'certname': '%i.Example.ORG'}})
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', cfg, cc, LOG, [])
+        found = helpers.DefaultingConfigParser()
+        found.read(self.conf_path)
+        self.assertEqual(found.get('agent', 'certname'),
+                         '%s.example.org' % cc.get_instance_id())
+
+    @t_help.mock.patch('socket.getfqdn')
+    def test_certname_lookups_done_once(self, m_getfqdn):
+        m_getfqdn.return_value = 'host.example.org'
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        cfg = self._puppet_cfg({'agent': {'certname': '%i.%f'},
+                                'master': {'certname': '%f'}})
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', cfg, cc, LOG, [])
+        self.assertEqual(m_getfqdn.call_count, 1)
+        found = helpers.DefaultingConfigParser()
+        found.read(self.conf_path)
+        self.assertEqual(found.get('agent', 'certname'),
+                         '%s.host.example.org' % cc.get_instance_id())
+        self.assertEqual(found.get('master', 'certname'), 'host.example.org')
+
+    @t_help.mock.patch.object(cc_puppet, '_get_puppet_ids',
+                              return_value=(1001, 0))
+    @t_help.mock.patch.object(cc_puppet.util, 'chownbyid')
+    def test_ca_cert_only_leaves_puppet_conf_alone(self, m_chown, m_ids):
+        ssl_dir = os.path.join(self.tmp, 'ssl')
+        cfg = self._puppet_cfg({'ca_cert': 'my ca cert'})
+        cfg['puppet']['ssl_dir'] = ssl_dir
+        cc_puppet.handle('cc_puppet', cfg, self._get_cloud('ubuntu'),
+                         LOG, [])
+        self.assertFalse(os.path.exists(self.conf_path))
+        self.assertEqual(
+            util.load_file(os.path.join(ssl_dir, 'certs', 'ca.pem')),
+            'my ca cert')
+        self.assertEqual(m_ids.call_count, 1)
+        self.assertEqual(
+            sorted(c[0] for c in m_chown.call_args_list),
+            sorted([(ssl_dir, 1001, 0),
+                    (os.path.join(ssl_dir, 'certs'), 1001, 0),
+                    (os.path.join(ssl_dir, 'certs', 'ca.pem'), 1001, 0)]))
+        self.assertEqual(os.stat(ssl_dir).st_mode & 0o777, 0o771)
+
+    def test_install_false_string(self):
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {'puppet': {'install': 'false'}},
+                         cc, LOG, [])
+        self.assertFalse(cc.distro.install_packages.called)
+
+    def test_numeric_version(self):
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {'puppet': {'version': 3.8}},
+                         cc, LOG, [])
+        cc.distro.install_packages.assert_called_once_with(('puppet', '3.8'))
+
+    def _fake_agent(self, cmdline):
+        # A pidfile pointing at a process with the given cmdline
+        pidfile = os.path.join(self.tmp, 'agent.pid')
+        util.write_file(pidfile, '4242\n')
+        real_load_file = util.load_file
+
+        def load_file(fname, *args, **kwargs):
+            if fname == '/proc/4242/cmdline':
+                return cmdline
+            return real_load_file(fname, *args, **kwargs)
+
+        for patcher in (
+                t_help.mock.patch.object(cc_puppet, '_AGENT_PIDFILES',
+                                         ('/does/not/exist', pidfile)),
+                t_help.mock.patch.object(cc_puppet.util, 'load_file',
+                                         side_effect=load_file)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_not_started_when_running(self):
+        self._fake_agent('/usr/bin/ruby\x00/usr/bin/puppet\x00agent\x00')
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+        start = t_help.mock.call(self.start_cmd, capture=False)
+        self.assertNotIn(start, self.mock_subp.call_args_list)
+
+    def test_started_when_pid_reused(self):
+        self._fake_agent('/usr/sbin/sshd\x00-D\x00')
+        cc = self._get_cloud('ubuntu')
+        cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+        self.mock_subp.assert_called_with(self.start_cmd, capture=False)
+
+    def test_started_with_stale_pidfile(self):
+        pidfile = os.path.join(self.tmp, 'agent.pid')
+        util.write_file(pidfile, 'not a pid\n')
+        cc = self._get_cloud('ubuntu')
+        with t_help.mock.patch.object(cc_puppet, '_AGENT_PIDFILES',
+                                      (pidfile,)):
+            cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+        self.mock_subp.assert_called_with(self.start_cmd, capture=False)
+
+    def test_no_service_start_when_enable_started_it(self):
+        cc = self._get_cloud('ubuntu')
+        with t_help.mock.patch.object(cc_puppet, '_autostart_puppet',
+                                      return_value=True):
+            cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+        self.assertFalse(self.mock_subp.called)
+
+    def test_installed_version_not_reinstalled(self):
+        cc = self._get_cloud('ubuntu')
+        with t_help.mock.patch.object(cc_puppet, '_installed_version',
+                                      return_value='3.8.5-2'):
+            cc_puppet.handle('cc_puppet', {'puppet': {'version': '3.8.5'}},
+                             cc, LOG, [])
+            self.assertFalse(cc.distro.install_packages.called)
+            cc_puppet.handle('cc_puppet', {'puppet': {}}, cc, LOG, [])
+            self.assertFalse(cc.distro.install_packages.called)
+
+    def test_other_version_installed(self):
+        cc = self._get_cloud('ubuntu')
+        with t_help.mock.patch.object(cc_puppet, '_installed_version',
+                                      return_value='3.7.0-1'):
+            cc_puppet.handle('cc_puppet', {'puppet': {'version': '3.8.5'}},
+                             cc, LOG, [])
+        cc.distro.install_packages.assert_called_once_with(
+            ('puppet', '3.8.5'))
+
+    @t_help.mock.patch('socket.getfqdn')
+    def test_static_certname_needs_no_lookups(self, m_getfqdn):
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        cfg = self._puppet_cfg({'agent': {'certname': 'Static.Example.ORG'}})
+        cc = self._get_cloud('ubuntu')
+        cc.get_instance_id = t_help.mock.MagicMock()
+        cc_puppet.handle('cc_puppet', cfg, cc, LOG, [])
+        self.assertFalse(m_getfqdn.called)
+        self.assertFalse(cc.get_instance_id.called)
+        found = helpers.DefaultingConfigParser()
+        found.read(self.conf_path)
+        self.assertEqual(found.get('agent', 'certname'), 'static.example.org')
+
+    def test_backup_is_previous_file(self):
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        util.write_file(self.conf_path + '.old', 'stale backup')
+        orig_ino = os.stat(self.conf_path).st_ino
+        cfg = self._puppet_cfg({'agent': {'server': 'puppet.example.org'}})
+        cc_puppet.handle('cc_puppet', cfg, self._get_cloud('ubuntu'),
+                         LOG, [])
+        self.assertEqual(util.load_file(self.conf_path + '.old'),
+                         STOCK_CONFIG)
+        self.assertEqual(os.stat(self.conf_path + '.old').st_ino, orig_ino)
+        self.assertNotEqual(os.stat(self.conf_path).st_ino, orig_ino)
+        self.assertEqual(os.stat(self.conf_path).st_mode & 0o777, 0o644)
+        self.assertFalse(os.path.exists(self.conf_path + '.tmp'))
+
+    def test_malformed_puppet_conf_left_alone(self):
+        contents = "[main]\nlogdir = /var/log/puppet\nbroken line\n"
+        util.write_file(self.conf_path, contents)
+        cfg = self._puppet_cfg({'agent': {'server': 'puppet.example.org'}})
+        self.assertRaises(ValueError, cc_puppet.handle, 'cc_puppet', cfg,
+                          self._get_cloud('ubuntu'), LOG, [])
+        self.assertEqual(util.load_file(self.conf_path), contents)
+        self.assertFalse(os.path.exists(self.conf_path + '.old'))
+
+    def test_new_sections_appended_in_order(self):
+        util.write_file(self.conf_path, STOCK_CONFIG)
+        cfg = self._puppet_cfg({'agent': {'server': 'puppet.example.org'}})
+        cc_puppet.handle('cc_puppet', cfg, self._get_cloud('ubuntu'),
+                         LOG, [])
+        sections = cc_puppet._parse_puppet_conf(
+            util.load_file(self.conf_path))
+        self.assertEqual(list(sections.keys()), ['main', 'master', 'agent'])
+        self.assertEqual(list(sections['main'].keys()), ['logdir', 'vardir'])
+
+
+class TestPuppetConf(t_help.TestCase):
+    def test_parse(self):
+        contents = "\n".join([
+            "# a comment",
+            "[main]",
+            "logdir = /var/log/puppet",
+            "; another comment",
+            "vardir: /var/lib/puppet",
+            "",
+            "[agent]",
+            "server=puppet.example.org  ",
+        ])
+        self.assertEqual(
+            cc_puppet._parse_puppet_conf(contents),
+            {'main': {'logdir': '/var/log/puppet',
+                      'vardir': '/var/lib/puppet'},
+             'agent': {'server': 'puppet.example.org'}})
+
+    def test_write_round_trips(self):
+        sections = {'main': {'logdir': '/var/log/puppet'},
+                    'agent': {'server': 'puppet.example.org'}}
+        fh = BytesIO()
+        cc_puppet._write_puppet_conf(fh, sections)
+        contents = util.decode_binary(fh.getvalue())
+        self.assertIn("[main]\nlogdir = /var/log/puppet\n\n", contents)
+        self.assertEqual(
+            cc_puppet._parse_puppet_conf(contents), sections)
+
+    def test_parse_refuses_unparseable_line(self):
+        self.assertRaises(ValueError, cc_puppet._parse_puppet_conf,
+                          "[main]\nkey\n")
+
+    def test_parse_refuses_option_before_section(self):
+        self.assertRaises(ValueError, cc_puppet._parse_puppet_conf,
+                          "server = a\n[main]\nlogdir = /tmp\n")
+
+    def test_parse_section_with_comment(self):
+        self.assertEqual(
+            cc_puppet._parse_puppet_conf(
+                "[main]  # the main section\nlogdir = /x\n"),
+            {'main': {'logdir': '/x'}})
+
+    def test_parse_lowers_option_names(self):
+        self.assertEqual(
+            cc_puppet._parse_puppet_conf("[agent]\nServer = a\n"),
+            {'agent': {'server': 'a'}})
+
+    def test_order_preserved(self):
+        contents = "\n".join([
+            "[main]",
+            "logdir = /var/log/puppet",
+            "vardir = /var/lib/puppet",
+            "ssldir = /var/lib/puppet/ssl",
+            "rundir = /var/run/puppet",
+            "factpath = $vardir/lib/facter",
+            "[agent]",
+            "server = puppet",
+            "[master]",
+            "ssl_client_header = SSL_CLIENT_S_DN",
+        ])
+        sections = cc_puppet._parse_puppet_conf(contents)
+        self.assertEqual(list(sections.keys()), ['main', 'agent', 'master'])
+        self.assertEqual(list(sections['main'].keys()),
+                         ['logdir', 'vardir', 'ssldir', 'rundir', 'factpath'])
+        fh = BytesIO()
+        cc_puppet._write_puppet_conf(fh, sections)
+        written = util.decode_binary(fh.getvalue())
+        self.assertEqual([line for line in written.splitlines() if line],
+                         contents.splitlines())
+
+
+class TestExpandCertname(t_help.TestCase):
+    @t_help.mock.patch('socket.getfqdn', return_value='Host.Example.ORG')
+    def test_expand(self, m_getfqdn):
+        cc = t_help.mock.MagicMock()
+        cc.get_instance_id.return_value = 'i-ABC'
+        lookups = {}
+        self.assertEqual(
+            cc_puppet._expand_certname('%i.%f.%i', cc, lookups),
+            'i-abc.host.example.org.i-abc')
+        self.assertEqual(cc_puppet._expand_certname('%f', cc, lookups),
+                         'host.example.org')
+        self.assertEqual(m_getfqdn.call_count, 1)
+        self.assertEqual(cc.get_instance_id.call_count, 1)
+
+    def test_no_tokens(self):
+        cc = t_help.mock.MagicMock()
+        self.assertEqual(cc_puppet._expand_certname('100%.Static', cc, {}),
+                         '100%.static')
+        self.assertFalse(cc.get_instance_id.called)
+
+
+class TestPuppetConstants(t_help.TestCase):
+    def test_defaults(self):
+        pc = cc_puppet.PuppetConstants(cc_puppet.DEFAULT_CONF_DIR,
+                                       cc_puppet.DEFAULT_SSL_DIR, LOG)
+        self.assertEqual(pc.conf_path, '/etc/puppet/puppet.conf')
+        self.assertEqual(pc.ssl_cert_dir, '/var/lib/puppet/ssl/certs')
+        self.assertEqual(pc.ssl_cert_path, '/var/lib/puppet/ssl/certs/ca.pem')
+
+    def test_overridden(self):
+        pc = cc_puppet.PuppetConstants('/etc/puppetlabs/puppet',
+                                       '/etc/puppetlabs/puppet/ssl', LOG)
+        self.assertEqual(pc.conf_path, '/etc/puppetlabs/puppet/puppet.conf')
+        self.assertEqual(pc.ssl_cert_dir, '/etc/puppetlabs/puppet/ssl/certs')
+        self.assertEqual(pc.ssl_cert_path,
+                         '/etc/puppetlabs/puppet/ssl/certs/ca.pem')
+
+
+class TestAutostart(t_help.TestCase):
+    def _detect(self, existing):
+        with t_help.mock.patch('cloudinit.config.cc_puppet.os.path.exists',
+                               side_effect=lambda p: p in existing):
+            return cc_puppet._detect_autostart()
+
+    def test_default_file_preferred(self):
+        (cmd, starts) = self._detect(['/etc/default/puppet',
+                                      '/bin/systemctl'])
+        self.assertEqual(cmd[0], 'sed')
+        self.assertFalse(starts)
+
+    def test_systemctl(self):
+        self.assertEqual(
+            self._detect(['/bin/systemctl', '/sbin/chkconfig']),
+            (['/bin/systemctl', 'enable', '--now', 'puppet.service'], True))
+
+    def test_chkconfig(self):
+        self.assertEqual(self._detect(['/sbin/chkconfig']),
+                         (['/sbin/chkconfig', 'puppet', 'on'], False))
+
+    def test_unknown(self):
+        self.assertIsNone(self._detect([]))
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_systemd_enables_and_starts(self, m_subp):
+        with t_help.mock.patch.object(
+                cc_puppet, '_detect_autostart',
+                return_value=(['/bin/systemctl', 'enable', '--now',
+                               'puppet.service'], True)):
+            self.assertTrue(cc_puppet._autostart_puppet(LOG))
+        m_subp.assert_called_once_with(
+            ['/bin/systemctl', 'enable', '--now', 'puppet.service'])
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_old_systemd_falls_back_to_enable(self, m_subp):
+        m_subp.side_effect = [
+            util.ProcessExecutionError(
+                exit_code=1,
+                stderr="systemctl: unrecognized option '--now'\n"),
+            None]
+        with t_help.mock.patch.object(
+                cc_puppet, '_detect_autostart',
+                return_value=(['/bin/systemctl', 'enable', '--now',
+                               'puppet.service'], True)):
+            self.assertFalse(cc_puppet._autostart_puppet(LOG))
+        m_subp.assert_called_with(
+            ['/bin/systemctl', 'enable', 'puppet.service'], capture=False)
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_failed_start_not_retried(self, m_subp):
+        m_subp.side_effect = util.ProcessExecutionError(
+            exit_code=1,
+            stderr="Job for puppet.service failed because the control"
+                   " process exited with error code.\n")
+        with t_help.mock.patch.object(
+                cc_puppet, '_detect_autostart',
+                return_value=(['/bin/systemctl', 'enable', '--now',
+                               'puppet.service'], True)):
+            self.assertRaises(util.ProcessExecutionError,
+                              cc_puppet._autostart_puppet, LOG)
+        self.assertEqual(m_subp.call_count, 1)
+
+
+class TestInstalledVersion(t_help.TestCase):
+    def _distro(self, osfamily):
+        distro = t_help.mock.MagicMock()
+        distro.osfamily = osfamily
+        return distro
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_dpkg(self, m_subp):
+        m_subp.return_value = ('install ok installed 3.8.5-2', '')
+        self.assertEqual(
+            cc_puppet._installed_version(self._distro('debian'), 'puppet'),
+            '3.8.5-2')
+        self.assertEqual(m_subp.call_args[0][0][0], 'dpkg-query')
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_dpkg_config_files_only(self, m_subp):
+        m_subp.return_value = ('deinstall ok config-files 3.8.5-2', '')
+        self.assertIsNone(
+            cc_puppet._installed_version(self._distro('debian'), 'puppet'))
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_rpm(self, m_subp):
+        m_subp.return_value = ('installed 3.8.5-1.el7', '')
+        self.assertEqual(
+            cc_puppet._installed_version(self._distro('redhat'), 'puppet'),
+            '3.8.5-1.el7')
+        self.assertEqual(m_subp.call_args[0][0][0], 'rpm')
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_not_installed(self, m_subp):
+        m_subp.side_effect = util.ProcessExecutionError(exit_code=1)
+        self.assertIsNone(
+            cc_puppet._installed_version(self._distro('redhat'), 'puppet'))
+
+    @t_help.mock.patch.object(cc_puppet.util, 'subp')
+    def test_unknown_distro(self, m_subp):
+        self.assertIsNone(
+            cc_puppet._installed_version(self._distro('gentoo'), 'puppet'))
+        self.assertFalse(m_subp.called)
+
+    def test_version_matches(self):
+        self.assertTrue(cc_puppet._version_matches('3.8.5-1.el7', '3.8.5'))
+        self.assertTrue(cc_puppet._version_matches('3.8.5-2', '3.8.5-2'))
+        self.assertFalse(cc_puppet._version_matches('3.8.5-2', '3.8'))
+        self.assertTrue(cc_puppet._version_matches('3.8.5-2', None))